@@ -21,15 +21,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
+import collections
+import heapq
+import math
 import numpy as np
+import operator
+import random
 import re
 import string
+import threading
 
 from functools import reduce
 
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from tensorflow.compiler.tf2xla.ops import gen_xla_ops
+from tensorflow.python.framework import dtypes
 from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import control_flow_ops
@@ -110,6 +118,7 @@ def bessel_i0(x, name=None):
   @end_compatibility
   """
   with ops.name_scope(name, 'bessel_i0', [x]):
+    x = ops.convert_to_tensor(x, name='x')
     return math_ops.exp(math_ops.abs(x)) * math_ops.bessel_i0e(x)
 
 
@@ -134,6 +143,7 @@ def bessel_i1(x, name=None):
   @end_compatibility
   """
   with ops.name_scope(name, 'bessel_i1', [x]):
+    x = ops.convert_to_tensor(x, name='x')
     return math_ops.exp(math_ops.abs(x)) * math_ops.bessel_i1e(x)
 
 
@@ -233,7 +243,7 @@ def einsum(equation, *inputs, **kwargs):
     *inputs: the inputs to contract (each one a `Tensor`), whose shapes should
       be consistent with `equation`.
     name: A name for the operation (optional).
-    optimize: `{False, True, 'dp', 'greedy'}`, optional
+    optimize: `{False, True, 'dp', 'greedy', 'random-greedy'}`, optional
       If not `False`, the contraction sequence will be optimized before 
       building the computation graph. Note that this will be ignored if the 
       function falls back to the exponential-space implementation.
@@ -241,6 +251,9 @@ def einsum(equation, *inputs, **kwargs):
       If `'dp'` or `'True'`, a dynamic programming approach (inspired by 
       arXiv:1304.6112) will be used to find an optimized contraction order.
       If `'greedy'`, a greedy algorithm will be used to optimize the order.
+      If `'random-greedy'`, the cheapest of several randomized greedy
+      sequences will be used; the sampling uses a fixed seed, so the same
+      contraction always yields the same sequence.
       The default value is `'True'`. 
   
   Returns:
@@ -281,15 +294,77 @@ def einsum(equation, *inputs, **kwargs):
           raise ValueError(
               'Subscript not supported: an axis appears more than once: %s' %
               input_labels)
-    for a in axis_labels:
-      input_count = sum(1 for s in input_axis_labels if a in s)
-      if input_count > 2 and a not in output_axis_labels:
+
+    # no axis appears more than once in an input, so counting the labels of
+    # all inputs gives the number of inputs each axis appears in
+    input_count = collections.Counter(''.join(input_axis_labels))
+    for a, count in input_count.items():
+      if count > 2 and a not in output_axis_labels:
         logging.warn(
             'Falling back to exponential-space implementation of einsum()'
             ' because index "%s" is summed over more than two inputs.', a)
         return _exponential_space_einsum(equation, *inputs)
 
-    if _enclosing_tpu_context() is not None and len(inputs) == 2:
+    # a tensor that is given twice, where each occurrence has axes of its own
+    # which are summed over, is the square of a single reduction, e.g.
+    # einsum('nlp,nlq->l', b, b) = einsum('nl->l', square(reduce_sum(b, 2)))
+    i = 0
+    while i < len(inputs):
+      for j in range(i + 1, len(inputs)):
+        li, lj = input_axis_labels[i], input_axis_labels[j]
+        if inputs[j] is not inputs[i] or len(li) != len(lj):
+          continue
+        axis = [p for p, (a, b) in enumerate(zip(li, lj)) if a != b]
+        if all(input_count[a] == 1 and
+               a not in output_axis_labels
+               for p in axis for a in (li[p], lj[p])):
+          t = inputs[i]
+          if axis:
+            t = math_ops.reduce_sum(t, axis=axis)
+          inputs[i] = math_ops.square(t)
+          input_axis_labels[i] = ''.join(
+              a for p, a in enumerate(li) if p not in axis)
+          del inputs[j], input_axis_labels[j]
+          input_count = collections.Counter(''.join(input_axis_labels))
+          break
+      else:
+        i += 1
+
+    # axes that appear in a single input and not in the output can be summed
+    # over before any contraction takes place
+    for i, input_labels in enumerate(input_axis_labels):
+      axis = [
+          j for j, a in enumerate(input_labels)
+          if input_count[a] == 1 and a not in output_axis_labels
+      ]
+      if axis:
+        inputs[i] = math_ops.reduce_sum(inputs[i], axis=axis)
+        input_axis_labels[i] = ''.join(
+            a for j, a in enumerate(input_labels) if j not in axis)
+
+    # if all inputs have the same axes as the output, this is an element-wise
+    # (Hadamard) product
+    if all(sorted(l) == sorted(output_axis_labels) for l in input_axis_labels):
+      return reduce(math_ops.multiply, [
+          _transpose_if_necessary(t, [l.index(a) for a in output_axis_labels])
+          for t, l in zip(inputs, input_axis_labels)
+      ])
+
+    # if no axis is shared between any two inputs, this is an outer product
+    if sorted(''.join(input_axis_labels)) == sorted(output_axis_labels):
+      product = reduce(
+          lambda t0, t1: math_ops.tensordot(t0, t1, axes=0), inputs)
+      product_axis_labels = ''.join(input_axis_labels)
+      return _transpose_if_necessary(
+          product, [product_axis_labels.index(a) for a in output_axis_labels])
+
+    # inside an XLA context, pairwise contractions are left to XlaEinsum so
+    # that XLA can choose layouts for the whole contraction
+    use_xla_einsum = (
+        _enclosing_tpu_context() is not None and
+        all(t.dtype in (dtypes.bfloat16, dtypes.float32) for t in inputs))
+
+    if use_xla_einsum and len(inputs) == 2:
       return gen_xla_ops.xla_einsum(
           inputs[0], inputs[1], input_axis_labels[0] + ',' +
           input_axis_labels[1] + '->' + output_axis_labels)
@@ -305,14 +380,26 @@ def einsum(equation, *inputs, **kwargs):
       optimize=optimize
     )
     
+    bit_of, lbits, obits = _einsum_label_bits(
+        input_axis_labels, output_axis_labels)
+    operands = list(zip(inputs, input_axis_labels, lbits))
+
     for j, k in seq:
       if j > k: j, k = k, j
-      t2, l2 = inputs.pop(k), input_axis_labels.pop(k)
-      t1, l1 = inputs.pop(j), input_axis_labels.pop(j)
-      axes_to_sum = (set(l1) & set(l2)) - set(output_axis_labels)
-      t3, l3 = _einsum_reduction(t1, l1, t2, l2, axes_to_sum)
-      inputs.insert(0, t3)
-      input_axis_labels.insert(0, l3)
+      t2, l2, b2 = operands.pop(k)
+      t1, l1, b1 = operands.pop(j)
+      contraction_bits = b1 & b2 & ~obits
+      if use_xla_einsum:
+        l3 = ''.join(a for a in l1 if not bit_of[a] & contraction_bits) + \
+             ''.join(a for a in l2 if not bit_of[a] & b1)
+        t3 = gen_xla_ops.xla_einsum(t1, t2, '{},{}->{}'.format(l1, l2, l3))
+      else:
+        t3, l3 = _einsum_reduction(
+            t1, l1, t2, l2, bit_of, b1, b2, contraction_bits)
+      operands.insert(0, (t3, l3, (b1 | b2) & ~contraction_bits))
+
+    t, l, _ = operands[0]
+    inputs, input_axis_labels = [t], [l]
     
     missing_indices = set(input_axis_labels[0]) - set(output_axis_labels)
 
@@ -321,14 +408,15 @@ def einsum(equation, *inputs, **kwargs):
           i for i, a in enumerate(input_axis_labels[0])
           if a not in output_axis_labels
       ]
-      temp = math_ops.reduce_sum(inputs[0], axis=axis)
-      temp_axis_labels = ''.join(
+      inputs[0] = math_ops.reduce_sum(inputs[0], axis=axis)
+      input_axis_labels[0] = ''.join(
           a for a in input_axis_labels[0] if a in output_axis_labels)
     
     if sorted(input_axis_labels[0]) != sorted(output_axis_labels):
       raise ValueError('Invalid equation: %s' % equation)
     
-    perm = [input_axis_labels[0].index(a) for a in output_axis_labels]
+    position = {a: i for i, a in enumerate(input_axis_labels[0])}
+    perm = [position[a] for a in output_axis_labels]
     return _transpose_if_necessary(inputs[0], perm)
 
   
@@ -339,15 +427,55 @@ def einsum_optimize(ishapes, ilabels, olabels, **kwargs):
 
   if not optimize:
     return [(0,1)]*(len(ishapes)-1)
-  elif optimize in {True, 'dp'}:
+  elif optimize == 'random-greedy' and kwargs.get('seed', 0) is None:
+    # unseeded samples differ from call to call and are not cached
+    return _einsum_optimize(ishapes, ilabels, olabels, optimize, **kwargs)
+
+  # optimizing the same contraction again yields the same sequence, so the
+  # results are kept in a least recently used cache
+  key = (
+    tuple(tuple(d) for d in ishapes), tuple(ilabels), olabels, optimize,
+    tuple(sorted(kwargs.items()))
+  )
+  with _EINSUM_OPTIMIZE_CACHE_LOCK:
+    seq = _EINSUM_OPTIMIZE_CACHE.pop(key, None)
+    if seq is not None:
+      _EINSUM_OPTIMIZE_CACHE[key] = seq
+      return list(seq)
+
+  # einsum() may be traced from several threads; the optimization itself runs
+  # outside the lock, only the cache update is guarded
+  seq = tuple(_einsum_optimize(ishapes, ilabels, olabels, optimize, **kwargs))
+  with _EINSUM_OPTIMIZE_CACHE_LOCK:
+    _EINSUM_OPTIMIZE_CACHE.pop(key, None)
+    while len(_EINSUM_OPTIMIZE_CACHE) >= _EINSUM_OPTIMIZE_CACHE_SIZE:
+      _EINSUM_OPTIMIZE_CACHE.popitem(last=False)
+    _EINSUM_OPTIMIZE_CACHE[key] = seq
+  return list(seq)
+
+
+_EINSUM_OPTIMIZE_CACHE = collections.OrderedDict()
+_EINSUM_OPTIMIZE_CACHE_SIZE = 1024
+_EINSUM_OPTIMIZE_CACHE_LOCK = threading.Lock()
+
+
+def _einsum_optimize(ishapes, ilabels, olabels, optimize, **kwargs):
+  if optimize in {True, 'dp'}:
     cost_limit = kwargs.pop('cost_limit', np.inf)
-    return _einsum_optimize_dp(ishapes, ilabels, olabels, cost_limit)
+    memory_limit = kwargs.pop('memory_limit', None)
+    return _einsum_optimize_dp(
+      ishapes, ilabels, olabels, cost_limit, memory_limit)
   elif optimize == "greedy":
     return _einsum_optimize_greedy(ishapes, ilabels, olabels)
+  elif optimize == 'random-greedy':
+    return _einsum_optimize_random_greedy(ishapes, ilabels, olabels, **kwargs)
 
   raise ValueError('invalid optimization strategy "{}"'.format(optimize))
   
 
+_EINSUM_EQUATION_RE = re.compile(r'^([a-zA-Z,.]+)(->[a-zA-Z.]*)?$')
+
+
 def _einsum_parse_and_resolve_equation(equation, input_shapes):
   """Helper for einsum() that splits/resolves inputs & outputs.
 
@@ -368,7 +496,7 @@ def _einsum_parse_and_resolve_equation(equation, input_shapes):
       inputs given or broadcast axes "..." or output axes could not be resolved.
   """
   equation = equation.replace(' ', '')
-  match = re.match('^([a-zA-Z,.]+)(->[a-zA-Z.]*)?$', equation)
+  match = _EINSUM_EQUATION_RE.match(equation)
   if not match:
     raise ValueError('Indices have incorrect format: %s' % equation)
 
@@ -385,8 +513,8 @@ def _einsum_parse_and_resolve_equation(equation, input_shapes):
   # tensors of different length and unlabeled output.
   ellipsis_axes = ''
   if '...' in equation:
-    unused = ''.join([c for c in string.ascii_letters
-                      if c not in ''.join(input_axis_labels)])
+    used = set(''.join(input_axis_labels))
+    unused = ''.join(c for c in string.ascii_letters if c not in used)
     for i, ax in enumerate(input_axis_labels):
       if '...' in ax:
         parts = ax.split('...')
@@ -431,7 +559,8 @@ def _einsum_parse_and_resolve_equation(equation, input_shapes):
   return input_axis_labels, output_axis_labels
 
 
-def _einsum_reduction(t0, t0_axis_labels, t1, t1_axis_labels, axes_to_sum):
+def _einsum_reduction(t0, t0_axis_labels, t1, t1_axis_labels, bit_of,
+                      t0_bits, t1_bits, sum_bits):
   """Helper for einsum() that computes the result of a two-argument einsum().
 
   Args:
@@ -441,14 +570,18 @@ def _einsum_reduction(t0, t0_axis_labels, t1, t1_axis_labels, axes_to_sum):
     t1: a `Tensor`
     t1_axis_labels: a string to axis labels.  This string's length must equal
       the rank of t1.
-    axes_to_sum: set of labels of axes to be summed over
+    bit_of: dict mapping each axis label to its bit, as returned by
+      _einsum_label_bits().
+    t0_bits: bitmask of the labels in t0_axis_labels.
+    t1_bits: bitmask of the labels in t1_axis_labels.
+    sum_bits: bitmask of the labels of axes to be summed over
 
   Returns:
     A `Tensor` whose elements are obtained by summing, over all axes in
-    `axes_to_sum`, the corresponding elements of `t0` and `t1`.
+    `sum_bits`, the corresponding elements of `t0` and `t1`.
 
     For example, if t0_axis_labels == 'abijk', t1_axis_labels == 'acjkl', and
-    axes_to_sum == {j,k}, this will return a tensor x where
+    sum_bits has the bits of j and k, this will return a tensor x where
 
       out[a,b,c,i,l] = sum_j sum_k t0[a,b,i,j,k] * t1[a,c,j,k,l]
 
@@ -480,21 +613,19 @@ def _einsum_reduction(t0, t0_axis_labels, t1, t1_axis_labels, axes_to_sum):
   # As an example, if the einsum is abijk,acjkl->abcil, then "a" is a
   # preserved axis, "b" and "c" are broadcast axes, and "j" and "k" are
   # summed axes.
-  assert all(a in t0_axis_labels and a in t1_axis_labels for a in axes_to_sum)
-  preserved_axes = (set(t0_axis_labels) & set(t1_axis_labels)) - axes_to_sum
-  broadcast_axes = {}
-  for i, sym_list in enumerate([t0_axis_labels, t1_axis_labels]):
-    broadcast_axes[i] = set(sym_list) - preserved_axes - axes_to_sum
+  assert not sum_bits & ~(t0_bits & t1_bits)
+  preserved_bits = t0_bits & t1_bits & ~sum_bits
+  broadcast_bits = [t0_bits & ~t1_bits, t1_bits & ~t0_bits]
 
   # Reorder the axes so that:
   # 1. preserved axes come first in both inputs
   # 2. in input 0, broadcast axes come next, followed by summed axes
   # 3. in input 1, summed axes come next, followed by broadcast axes
   def sort_key(input_index, a):
-    if a in preserved_axes:
+    if bit_of[a] & preserved_bits:
       return (-1, a)
-    elif ((input_index == 0 and a in broadcast_axes[0]) or
-          (input_index == 1 and a in axes_to_sum)):
+    elif ((input_index == 0 and bit_of[a] & broadcast_bits[0]) or
+          (input_index == 1 and bit_of[a] & sum_bits)):
       return (0, a)
     else:
       return (1, a)
@@ -504,21 +635,43 @@ def _einsum_reduction(t0, t0_axis_labels, t1, t1_axis_labels, axes_to_sum):
       sorted(sym_list, key=lambda a: sort_key(i, a))
       for i, sym_list in enumerate(axis_labels)
   ]
+  num_preserved = bin(preserved_bits).count('1')
+  num_summed = bin(sum_bits).count('1')
+  num_broadcast = [bin(b).count('1') for b in broadcast_bits]
+
+  # matmul() can itself transpose the two innermost axes of its inputs; if an
+  # input is already in the correct order except that its broadcast and
+  # summed axes are swapped, leave the swap to matmul() instead of
+  # transposing the input
+  adjoint = [False, False]
   inputs = [t0, t1]
   for i, axes_str in enumerate(axis_labels):
     perm = [axes_str.find(a) for a in sorted_axes[i]]
+    if sum_bits:
+      k = num_preserved + (num_broadcast[0] if i == 0 else num_summed)
+      swapped_perm = perm[:num_preserved] + perm[k:] + perm[num_preserved:k]
+      identity = list(range(len(perm)))
+      if perm != identity and swapped_perm == identity:
+        adjoint[i] = True
+        continue
     inputs[i] = _transpose_if_necessary(inputs[i], perm)
   t0, t1 = inputs
 
-  if not axes_to_sum:
+  if not sum_bits:
     # In the special case where there are no axes to sum over, reduce to mul()
-    # rather than to batch matrix multiplication.
-    for _ in broadcast_axes[1]:
-      t0 = array_ops.expand_dims(t0, -1)
-    for _ in broadcast_axes[0]:
-      t1 = array_ops.expand_dims(t1, len(preserved_axes))
+    # rather than to batch matrix multiplication. Only insert axes where some
+    # are missing: with unknown dimensions, _get_shape() adds shape ops and
+    # _reshape_if_necessary() cannot tell that nothing changes.
+    if num_broadcast[1]:
+      t0 = _reshape_if_necessary(
+          t0, _get_shape(t0) + [1] * num_broadcast[1])
+    if num_broadcast[0]:
+      t1_shape = _get_shape(t1)
+      t1 = _reshape_if_necessary(
+          t1, t1_shape[:num_preserved] + [1] * num_broadcast[0] +
+          t1_shape[num_preserved:])
     product = math_ops.multiply(t0, t1)
-    product_axes = sorted_axes[0] + sorted_axes[1][len(preserved_axes):]
+    product_axes = sorted_axes[0] + sorted_axes[1][num_preserved:]
     return product, ''.join(product_axes)
   else:
     # Reduce to matmul().
@@ -528,40 +681,58 @@ def _einsum_reduction(t0, t0_axis_labels, t1, t1_axis_labels, axes_to_sum):
     # single axis.
 
     t0_shape = _get_shape(t0)
-    num_broadcast_elements_t0 = _total_size(
-        t0_shape[len(preserved_axes):-len(axes_to_sum)])
-    num_summed_elements = _total_size(t0_shape[-len(axes_to_sum):])
-    new_shape = (
-        t0_shape[:len(preserved_axes)] +
-        [num_broadcast_elements_t0, num_summed_elements])
+    if adjoint[0]:
+      summed_shape = t0_shape[num_preserved:num_preserved + num_summed]
+      broadcast_shape_t0 = t0_shape[num_preserved + num_summed:]
+    else:
+      broadcast_shape_t0 = t0_shape[num_preserved:-num_summed]
+      summed_shape = t0_shape[-num_summed:]
+    num_broadcast_elements_t0 = _total_size(broadcast_shape_t0)
+    num_summed_elements = _total_size(summed_shape)
+    if adjoint[0]:
+      new_shape = (
+          t0_shape[:num_preserved] +
+          [num_summed_elements, num_broadcast_elements_t0])
+    else:
+      new_shape = (
+          t0_shape[:num_preserved] +
+          [num_broadcast_elements_t0, num_summed_elements])
     t0 = _reshape_if_necessary(t0, new_shape)
 
     t1_shape = _get_shape(t1)
-    num_broadcast_elements_t1 = _total_size(
-        t1_shape[len(preserved_axes) + len(axes_to_sum):])
-    new_shape = (
-        t1_shape[:len(preserved_axes)] +
-        [num_summed_elements, num_broadcast_elements_t1])
+    if adjoint[1]:
+      broadcast_shape_t1 = t1_shape[num_preserved:-num_summed]
+    else:
+      broadcast_shape_t1 = t1_shape[num_preserved + num_summed:]
+    num_broadcast_elements_t1 = _total_size(broadcast_shape_t1)
+    if adjoint[1]:
+      new_shape = (
+          t1_shape[:num_preserved] +
+          [num_broadcast_elements_t1, num_summed_elements])
+    else:
+      new_shape = (
+          t1_shape[:num_preserved] +
+          [num_summed_elements, num_broadcast_elements_t1])
     t1 = _reshape_if_necessary(t1, new_shape)
 
-    product = math_ops.matmul(t0, t1)
+    product = math_ops.matmul(
+        t0, t1, transpose_a=adjoint[0], transpose_b=adjoint[1])
 
     # Undo compaction of broadcast axes
     uncompacted_shape = (
-        t0_shape[:len(preserved_axes) + len(broadcast_axes[0])] +
-        t1_shape[len(t1_shape) - len(broadcast_axes[1]):])
+        t0_shape[:num_preserved] + broadcast_shape_t0 + broadcast_shape_t1)
     product = _reshape_if_necessary(product, uncompacted_shape)
 
     product_axes = (
-        sorted_axes[0][:len(preserved_axes) + len(broadcast_axes[0])] +
-        sorted_axes[1][len(sorted_axes[1]) - len(broadcast_axes[1]):])
+        sorted_axes[0][:num_preserved + num_broadcast[0]] +
+        sorted_axes[1][len(sorted_axes[1]) - num_broadcast[1]:])
 
     return product, ''.join(product_axes)
 
 
 def _transpose_if_necessary(tensor, perm):
   """Like transpose(), but avoids creating a new tensor if possible."""
-  if perm != range(len(perm)):
+  if perm != list(range(len(perm))):
     return array_ops.transpose(tensor, perm=perm)
   else:
     return tensor
@@ -599,40 +770,105 @@ def _total_size(shape_values):
   array_ops.shape), then it returns a scalar tensor.
   If not, it returns an integer."""
 
-  result = 1
-  for val in shape_values:
-    result *= val
-  return result
+  return reduce(operator.mul, shape_values, 1)
 
 
 
-def _einsum_optimize_dp(ishapes, ilabels, olabels, cost_limit=np.inf):
+def _einsum_label_bits(ilabels, olabels):
+  """Assigns a bit to each axis label of an einsum() contraction.
+
+  Args:
+    ilabels: List of strings with the axis labels of each input.
+    olabels: String with the axis labels of the output.
+
+  Returns:
+    bit_of, lbits, obits where:
+      bit_of: Dict mapping each label to a distinct power of two.
+      lbits: List with the bitmask of the labels of each input.
+      obits: Bitmask of the output labels.
+  """
+  bit_of = {
+    l: 1 << i for i, l in enumerate(sorted(set(''.join(ilabels) + olabels)))
+  }
+  lbits = [reduce(operator.or_, (bit_of[l] for l in ls), 0) for ls in ilabels]
+  obits = reduce(operator.or_, (bit_of[l] for l in olabels), 0)
+  return bit_of, lbits, obits
+
+
+def _einsum_label_dims(ishapes, ilabels, bit_of):
+  """Returns a dict mapping each label bit to the dimension of its axis."""
+  dim_of = {}
+  for shape, labels in zip(ishapes, ilabels):
+    for d, l in zip(shape, labels):
+      dim_of[bit_of[l]] = max(d, dim_of.get(bit_of[l], 1))
+  return dim_of
+
+
+def _einsum_size(bits, dim_of):
+  """Returns the number of elements of a tensor with label bitmask `bits`."""
+  size = 1
+  while bits:
+    bit = bits & -bits
+    size *= dim_of[bit]
+    bits ^= bit
+  return size
+
+
+def _einsum_optimize_dp(ishapes, ilabels, olabels, cost_limit=np.inf,
+                        memory_limit=None):
   # decompose the contraction graph into connected subgraphs and optimise
   # each subgraph using _einsum_optimize_dp_connected
+  if memory_limit == 'max_input':
+    memory_limit = max(_total_size(d) for d in ishapes)
+  subgraphs = _find_subgraphs(ilabels, olabels)
   c = [
     _einsum_optimize_dp_connected(
       [ishapes[j] for j in g], 
       [ilabels[j] for j in g], 
-      olabels, cost_limit, g
-    ) for g in _find_subgraphs(ilabels, olabels)
+      olabels, cost_limit, g, memory_limit
+    ) for g in subgraphs
   ]
-  return _tree_to_sequence(reduce(lambda c1, c2: (c1, c2), c))
+  return _tree_to_sequence(
+    _join_subgraphs(ishapes, ilabels, olabels, subgraphs, c))
+
+
+def _join_subgraphs(ishapes, ilabels, olabels, subgraphs, contractions):
+  # joins the contraction trees of disconnected subgraphs by outer products,
+  # always joining the two results whose product is smallest, e.g.
+  # sizes [2, 64, 2] --> ((0, 2), 1)
+  bit_of, lbits, obits = _einsum_label_bits(ilabels, olabels)
+  dim_of = _einsum_label_dims(ishapes, ilabels, bit_of)
+
+  # the labels of different subgraphs overlap in output labels only, and
+  # once a subgraph is contracted only its output labels are left
+  bits = [reduce(operator.or_, (lbits[j] for j in g)) & obits
+          for g in subgraphs]
+  trees = list(contractions)
+
+  while len(trees) > 1:
+    _, j, k = min(
+      (_einsum_size(bits[j] | bits[k], dim_of), j, k)
+      for j in range(len(trees)) for k in range(j + 1, len(trees))
+    )
+    b2, c2 = bits.pop(k), trees.pop(k)
+    b1, c1 = bits.pop(j), trees.pop(j)
+    bits.append(b1 | b2)
+    trees.append((c1, c2))
+  return trees[0]
 
 
 def _find_subgraphs(ilabels, olabels):
   subgraphs = []
   unused = set(range(len(ilabels)))
+  label_sets = [frozenset(l) - frozenset(olabels) for l in ilabels]
   
   while len(unused) > 0:
     g = []
-    q = [unused.pop()]
+    q = collections.deque([unused.pop()])
     while len(q) > 0:
-      x = q.pop(0)
+      x = q.popleft()
       g.append(x)
-      n = {
-        y for y in unused 
-        if len((set(ilabels[x]) & set(ilabels[y])) - set(olabels)) > 0
-      }
+      n = {y for y in unused if label_sets[x] & label_sets[y]}
       q.extend(n)
       unused -= n
     
@@ -642,23 +878,32 @@ def _find_subgraphs(ilabels, olabels):
 
 
 def _einsum_optimize_dp_connected(ishapes, ilabels, olabels, 
-                                  cost_limit=np.inf, tensor_indices=None):
+                                  cost_limit=np.inf, tensor_indices=None,
+                                  memory_limit=None):
                                   
   # find an optimal contraction using breadth-first search with dynamic 
-  # programming but ignoring solutions with intermediate outer products
-  # and solutions with contraction cost larger than cost_limit
+  # programming but ignoring solutions with intermediate outer products,
+  # solutions with contraction cost larger than cost_limit and solutions
+  # with an intermediate tensor larger than memory_limit; of two solutions
+  # with the same cost, the one with the smaller largest intermediate wins
   
   n = len(ishapes)
   if tensor_indices is None: 
     tensor_indices = list(range(n))
+
+  # represent sets of tensors and sets of labels as integer bitmasks: bit j of
+  # a tensor set stands for input j, the bit label_bit[l] for the label l
+  label_bit, lbits, obits = _einsum_label_bits(ilabels, olabels)
+  dim_of = _einsum_label_dims(ishapes, ilabels, label_bit)
+
   x = [
     None, # just ignore x[0]
     {
-      frozenset([j]): (ishapes[j], ilabels[j], 0, tensor_indices[j]) 
-      for j in range(n)
+      1 << j: (lbits[j], 0, 0, tensor_indices[j]) for j in range(n)
     }
   ]
-  # x[n_tensors][set of tensors] = (shape, labels, cost, contraction)
+  # x[n_tensors][set of tensors] = 
+  #   (label bits, cost, largest intermediate, contraction)
   
   for m in range(2, n+1): # construct x[m]
     x.append(dict())
@@ -666,40 +911,49 @@ def _einsum_optimize_dp_connected(ishapes, ilabels, olabels,
     for k in range(1, m//2+1): # try to combine all x[m-k] and x[k]
     
       for s1 in x[m-k]:
-        d1, l1, c1, e1 = x[m-k][s1]
+        b1, c1, p1, e1 = x[m-k][s1]
         
         for s2 in x[k]:
-          if len(s1 & s2) == 0:
-            d2, l2, c2, e2 = x[k][s2]
-            
-            s = s1 | s2
+          if s1 & s2 == 0:
+            b2, c2, p2, e2 = x[k][s2]
             
-            common_indices = set(l1) & set(l2)
-            contraction_indices = common_indices - set(olabels)
+            contraction_bits = b1 & b2 & ~obits
             
-            if len(contraction_indices) > 0: # ignore outer products
+            if contraction_bits: # ignore outer products
 
-              # m1[l] <-- is l1[l] an index of the new tensor? (m2 for l2)
-              m1 = [l not in contraction_indices for l in l1]
-              m2 = [l not in common_indices      for l in l2]
+              s = s1 | s2
 
-              new_shape = tuple(
-                [d for d, f in zip(d1, m1) if f] + \
-                [d for d, f in zip(d2, m2) if f]
-              )
-
-              new_labels = \
-                ''.join([l for l, f in zip(l1, m1) if f]) + \
-                ''.join([l for l, f in zip(l2, m2) if f])
+              # the labels of the new tensor are those of both tensors except
+              # for the contracted ones; the order of its axes does not
+              # matter for the cost, so only its label bits are needed
+              new_bits = (b1 | b2) & ~contraction_bits
               
-              contraction_cost = np.prod(d1) * \
-                                 np.prod([d for d, f in zip(d2, m2) if f])
+              # the cost of contracting two tensors is the size of the
+              # union of their index spaces
+              contraction_cost = _einsum_size(b1 | b2, dim_of)
               total_cost = contraction_cost + c1 + c2
+              peak = max(p1, p2, _einsum_size(new_bits, dim_of))
+
+              if memory_limit is not None and peak > memory_limit:
+                continue
               
-              if s not in x[m] or total_cost < min(x[m][s][2], cost_limit):
-                x[m][s] = (new_shape, new_labels, total_cost, (e1, e2))
+              if s not in x[m] or (
+                  total_cost < cost_limit and
+                  (total_cost, peak) < (x[m][s][1], x[m][s][2])):
+                x[m][s] = (new_bits, total_cost, peak, (e1, e2))
+
+  if (1 << n) - 1 not in x[n]:
+    if memory_limit is not None:
+      # no contraction stays within memory_limit
+      return _einsum_optimize_dp_connected(
+        ishapes, ilabels, olabels, cost_limit, tensor_indices)
+    # every pairwise contraction sums over the labels shared by both tensors,
+    # so a label summed over in more than two inputs leaves no valid path
+    raise ValueError(
+      'no pairwise contraction sequence for inputs {} with output {}; an '
+      'index is summed over more than two inputs'.format(ilabels, olabels))
 
-  return x[n][list(x[n].keys())[0]][3]
+  return x[n][(1 << n) - 1][3]
 
 
 def _tree_to_sequence(contraction):
@@ -709,84 +963,153 @@ def _tree_to_sequence(contraction):
   if type(contraction) == int:
     return []
   
-  t1 = [contraction]
+  t1 = collections.deque([contraction])
   t2 = []
   seq = []
   
   while len(t1) > 0:
-    x = t1.pop(0)
+    x = t1.popleft()
     assert type(x) == tuple and len(x) == 2
     t1_new = [t for t in x if type(t) == tuple][::-1]
     t2_new = [t for t in x if type(t) == int]
     assert len(t1_new) + len(t2_new) == 2
     
-    t1 = t1_new + t1
+    t1.extendleft(reversed(t1_new))
     seq_new = tuple(range(len(t1_new)))
     
     for t in sorted(t2_new):
-      p = max([0] + [j+1 for j,n in enumerate(t2) if n < t])
+      # t2 is sorted, so t goes behind all tensors with a smaller index
+      p = bisect.bisect_left(t2, t)
       t2.insert(p, t)
       seq_new += (p + len(t1),)
     
-    seq.insert(0, seq_new)
+    seq.append(seq_new)
 
+  seq.reverse()
   return seq
 
 
 def _einsum_optimize_greedy(ishapes, ilabels, olabels):
   
-  ishapes = list(ishapes)
-  ilabels = list(ilabels)
-  seq = []
+  # repeatedly contract the cheapest pair of tensors; the cost of a pair only
+  # depends on the two tensors involved, so all pair costs are kept in a heap
+  # and after each contraction only the pairs involving the new tensor have
+  # to be scored
+
+  bit_of, lbits, obits = _einsum_label_bits(ilabels, olabels)
+  dim_of = _einsum_label_dims(ishapes, ilabels, bit_of)
+  n = len(lbits)
   
-  total_cost = 0
+  # new tensors are prepended to the list of inputs; ranking tensors by their
+  # position in that list breaks ties between equally expensive pairs in
+  # favour of the pair that comes first
+  def rank(t):
+    return t if t < n else -t
   
-  while len(ishapes) > 1:
-    min_cost = np.inf
-    cheapest_contraction = None
-    
-    for j in range(len(ilabels)-1):
-      l1, d1 = ilabels[j], ishapes[j]
-      for k in range(j+1, len(ilabels)):
-        l2, d2 = ilabels[k], ishapes[k]
-        
-        common_indices = set(l1) & set(l2)
-        contraction_indices = common_indices - set(olabels)
-        
-        # m1[l] <-- is l1[l] an index of the new tensor? (m2 for l2)
-        m1 = [l not in contraction_indices for l in l1]
-        m2 = [l not in common_indices      for l in l2]
-        
-        new_shape = tuple(
-          [d for d, f in zip(d1, m1) if f] + \
-          [d for d, f in zip(d2, m2) if f]
-        )
-
-        new_labels = \
-          ''.join([l for l, f in zip(l1, m1) if f]) + \
-          ''.join([l for l, f in zip(l2, m2) if f])
-        
-        cost = np.prod(d1) * \
-               np.prod([d for d, f in zip(d2, m2) if f])
-        
-        if cost < min_cost:
-          min_cost = cost
-          cheapest_contraction = (j, k, new_shape, new_labels)
+  def pair(t1, t2):
+    if rank(t1) > rank(t2): t1, t2 = t2, t1
+    # the cost of contracting two tensors is the size of the union of their
+    # index spaces
+    cost = _einsum_size(lbits[t1] | lbits[t2], dim_of)
+    return (cost, rank(t1), rank(t2), t1, t2)
+  
+  heap = [pair(j, k) for j in range(n-1) for k in range(j+1, n)]
+  heapq.heapify(heap)
+  
+  order = list(range(n)) # tensors in the order of the list of inputs
+  alive = set(order)
+  seq = []
+  
+  while len(order) > 1:
+    _, _, _, t1, t2 = heapq.heappop(heap)
+    if t1 not in alive or t2 not in alive:
+      continue
     
-    j, k, d, l = cheapest_contraction
-    seq.append((j,k))
-    ishapes.pop(k)
-    ishapes.pop(j)
-    ishapes.insert(0, d)
-    ilabels.pop(k)
-    ilabels.pop(j)
-    ilabels.insert(0, l)
+    seq.append((order.index(t1), order.index(t2)))
+    order.remove(t1)
+    order.remove(t2)
+    alive -= {t1, t2}
     
-    total_cost += min_cost
+    t = len(lbits)
+    b1, b2 = lbits[t1], lbits[t2]
+    lbits.append((b1 | b2) & ~(b1 & b2 & ~obits))
+    for u in order:
+      heapq.heappush(heap, pair(t, u))
+    order.insert(0, t)
+    alive.add(t)
     
   return seq
 
 
+def _einsum_optimize_random_greedy(ishapes, ilabels, olabels, ntrials=32,
+                                   temperature=0.1, alpha=0.0, seed=0):
+  
+  # run the greedy algorithm ntrials times, but instead of always contracting
+  # the pair with the lowest score, sample the next contraction with
+  # probability exp(-score / temperature) (relative to the lowest score);
+  # the score of a pair is the size of the new tensor minus alpha times the
+  # sizes of the two contracted tensors (see arXiv:2002.01935); the first
+  # trial always picks the lowest score; return the sequence with the lowest
+  # total contraction cost, but never one that is more expensive than the
+  # one found by _einsum_optimize_greedy; the default seed is fixed, so the
+  # same contraction always gets the same sequence and reduction order
+
+  bit_of, lbits, obits = _einsum_label_bits(ilabels, olabels)
+  dim_of = _einsum_label_dims(ishapes, ilabels, bit_of)
+  rng = random.Random(seed)
+  
+  best_seq = _einsum_optimize_greedy(ishapes, ilabels, olabels)
+  tensors = list(lbits)
+  best_cost = 0
+  for j, k in best_seq:
+    b1, b2 = tensors[j], tensors[k]
+    best_cost += _einsum_size(b1 | b2, dim_of)
+    tensors.pop(k)
+    tensors.pop(j)
+    tensors.insert(0, (b1 | b2) & ~(b1 & b2 & ~obits))
+  
+  for trial in range(ntrials):
+    tensors = list(lbits)
+    seq = []
+    total_cost = 0
+    
+    while len(tensors) > 1 and total_cost < best_cost:
+      candidates = []
+      for j in range(len(tensors)-1):
+        b1 = tensors[j]
+        for k in range(j+1, len(tensors)):
+          b2 = tensors[k]
+          new_bits = (b1 | b2) & ~(b1 & b2 & ~obits)
+          score = _einsum_size(new_bits, dim_of) - alpha * (
+            _einsum_size(b1, dim_of) + _einsum_size(b2, dim_of))
+          candidates.append((score, j, k, new_bits))
+      
+      min_score = min(c[0] for c in candidates)
+      if trial == 0:
+        choice = next(c for c in candidates if c[0] == min_score)
+      else:
+        scale = temperature * max(abs(min_score), 1)
+        weights = [math.exp(-(c[0] - min_score) / scale) for c in candidates]
+        r = rng.random() * sum(weights)
+        for choice, w in zip(candidates, weights):
+          r -= w
+          if r < 0:
+            break
+      
+      _, j, k, new_bits = choice
+      total_cost += _einsum_size(tensors[j] | tensors[k], dim_of)
+      seq.append((j,k))
+      tensors.pop(k)
+      tensors.pop(j)
+      tensors.insert(0, new_bits)
+    
+    if len(tensors) == 1 and total_cost < best_cost:
+      best_cost = total_cost
+      best_seq = seq
+  
+  return best_seq
+
+
 def _exponential_space_einsum(equation, *inputs):
   """Fallback implementation that supports summing an index over > 2 inputs."""
   inputs = list(inputs)
@@ -854,9 +1177,29 @@ def _exponential_space_einsum(equation, *inputs):
   expanded_inputs = [
       array_ops.reshape(input_, shape) for input_, shape in zip(inputs, shapes)
   ]
-  expanded_output = 1
-  for input_ in expanded_inputs:
-    expanded_output *= input_
+
+  # multiply pairwise, always combining the two smallest tensors first, so
+  # that the broadcast intermediates stay as small as possible; unknown
+  # dimensions (-1) are counted as 1
+  def broadcast_dim(d0, d1):
+    if d0 == 1:
+      return d1
+    if d1 == 1:
+      return d0
+    return max(d0, d1)
+
+  heap = [(_total_size([abs(d) for d in shape]), i, shape, input_)
+          for i, (shape, input_) in enumerate(zip(shapes, expanded_inputs))]
+  heapq.heapify(heap)
+  i = len(heap)
+  while len(heap) > 1:
+    _, _, shape0, input0 = heapq.heappop(heap)
+    _, _, shape1, input1 = heapq.heappop(heap)
+    shape = [broadcast_dim(d0, d1) for d0, d1 in zip(shape0, shape1)]
+    heapq.heappush(heap, (_total_size([abs(d) for d in shape]), i, shape,
+                          math_ops.multiply(input0, input1)))
+    i += 1
+  expanded_output = heap[0][3]
 
   # contract
   return math_ops.reduce_sum(expanded_output, reduction_idx)
@@ -215,7 +215,8 @@ class EinsumTest(test.TestCase):
       'ab,ba', 'abc,abc', 'abc,bac', 'abc,cba', 'dba,ead,cad->bce',
       'aef,fbc,dca->bde', 'iJ,Jk->ik', 'iJ,Ki->JK', 'iJk,Jklm->Jk',
       'ij, jk, kl -> il', 'a, ab, abc -> abc', 'ab, ab, cd, cd, ef, ef -> ',
-      'abc, bac', 'iJ, Ki -> JK', 'iJk, Jklm -> Jk', 'ii', 'ijji'
+      'abc, bac', 'iJ, Ki -> JK', 'iJk, Jklm -> Jk', 'ii', 'ijji',
+      'ab,bc->c', 'ijk,jl->', 'nlp,nlq->l', 'ij,ji->ij', 'abc,cab,bca->bac'
   ]
 
   long_cases = [
@@ -363,7 +364,7 @@ class EinsumTest(test.TestCase):
 
     input_tensors = [constant_op.constant(val) for val in input_vals]
     
-    for o in [False, True, 'dp', 'greedy']:
+    for o in [False, True, 'dp', 'greedy', 'random-greedy']:
       output_tensor = special_math_ops.einsum(axes, *input_tensors, optimize=o)
       with self.session(use_gpu=True):
         output_value = self.evaluate(output_tensor)
@@ -371,6 +372,16 @@ class EinsumTest(test.TestCase):
       err = np.abs(correct_value - output_value).max()
       self.assertLess(err, 1e-8)
 
+  @test_util.run_in_graph_and_eager_modes
+  def test_repeated_input(self):
+    cases = [('nlp,nlq->l', (3, 4, 5)), ('nlp,nlq->lq', (3, 4, 5)),
+             ('nl,nl->l', (3, 4)), ('ij,ji->', (4, 4))]
+    for axes, shape in cases:
+      val = np.random.random(shape)
+      t = constant_op.constant(val)
+      output = special_math_ops.einsum(axes, t, t)
+      self.assertAllClose(np.einsum(axes, val, val), self.evaluate(output))
+
   def test_input_is_placeholder(self):
     with ops.Graph().as_default():
       m0 = array_ops.placeholder(dtypes.int32, shape=(1, None))
@@ -533,12 +544,93 @@ class EinsumOptimizeTest(test.TestCase):
         r
       )
 
+  def test_random_greedy(self):
+    self.assertEqual(
+      special_math_ops.einsum_optimize(
+        [(16,16), (16,16), (16,)], ["jk", "kl", "l"], "j",
+        optimize='random-greedy'
+      ),
+      [(1,2), (0,1)]
+    )
+    
+    # the network of test_4, where greedy misses the optimal sequence, but
+    # the first trial, which ranks pairs by the size of the new tensor,
+    # already finds it
+    self.assertEqual(
+      special_math_ops.einsum_optimize(
+        [(2,16,16), (2,2,2,2), (2,16,16), (16,2,16)],
+        ["qmj", "krnq", "rpl", "mnp"], "jkl",
+        optimize='random-greedy', seed=0
+      ),
+      [(0,3), (0,1), (0,1)]
+    )
+
+    # jk,kl and ij,jk both give a 4x4 tensor; greedy and the first trial
+    # contract jk,kl first (cost 160), only a sampled trial finds the
+    # cheaper order (cost 128)
+    args = ([(4,2), (2,4), (8,4)], ["jk", "kl", "ij"], "il")
+    self.assertEqual(
+      special_math_ops.einsum_optimize(*args, optimize='greedy'),
+      [(0,1), (0,1)]
+    )
+    self.assertEqual(
+      special_math_ops.einsum_optimize(
+        *args, optimize='random-greedy', ntrials=1),
+      [(0,1), (0,1)]
+    )
+    self.assertEqual(
+      special_math_ops.einsum_optimize(*args, optimize='random-greedy'),
+      [(0,2), (0,1)]
+    )
+
+  def test_memory_limit(self):
+    """
+    The cheapest contraction of abc and daf first creates an intermediate
+    bcdf which is larger than any of the inputs. With
+    memory_limit='max_input', abc and efb are contracted first instead.
+    """
+
+    ishapes = [(10,100,3), (10,3,100), (5,10,3)]
+    ilabels = ["abc", "efb", "daf"]
+    olabels = "cde"
+
+    results = [
+      (None,        [(0,2), (0,1)]),
+      ('max_input', [(0,1), (0,1)]),
+      (1,           [(0,2), (0,1)]) # no path within the limit
+    ]
+
+    for memory_limit, r in results:
+      self.assertEqual(
+        special_math_ops.einsum_optimize(
+          ishapes, ilabels, olabels,
+          optimize='dp', memory_limit=memory_limit
+        ),
+        r
+      )
+
+  def test_cache(self):
+    args = ([(16,16), (16,16), (16,)], ["jk", "kl", "l"], "j")
+    for o in self.optimizations + ['random-greedy']:
+      seq = special_math_ops.einsum_optimize(*args, optimize=o)
+      expected = list(seq)
+      seq.append((0,1)) # modifying the result must not affect the cache
+      self.assertEqual(
+        special_math_ops.einsum_optimize(*args, optimize=o), expected)
+
   def test_invalid(self):
     with self.assertRaises(ValueError):
       special_math_ops.einsum_optimize(
         [(16,16), (16,)], ["jk", "k"], "j",
         optimize='invalid'
       )
+
+    # d is summed over three inputs, which no pairwise sequence can do
+    with self.assertRaises(ValueError):
+      special_math_ops.einsum_optimize(
+        [(16,16), (16,8), (8,8,16)], ["ad", "dc", "cbd"], "abc",
+        optimize='dp'
+      )
         
 
 if __name__ == '__main__':